@@ -1,160 +1,236 @@
 ''' Author: Bassem Boustany '''
 
 import numpy as np
+from numba import njit, prange
 import pandas as pd
-from scipy.stats import norm
+from numpy.random import default_rng
 import matplotlib.pyplot as plt
 import time
 import sys
-import warnings
 import os
 
-warnings.filterwarnings('error')
+#random generator used to draw the cash flows, set SEED to an integer for reproducible simulations
+SEED = None
+rng = default_rng(SEED)
 
-'''Computes NPV'''
-def npv(cf_list, rate):
-	npv = 0
-	i = 0
-	for cf in cf_list:
-		npv += cf/(1+rate)**i
-		i += 1
-	return npv
+#simulations with at least this many cash flows (n_sims*life) are stored in float32 to halve memory traffic,
+#the IRR Newton iterations still run in float64
+FLOAT32_MIN_SIZE = 10_000_000
 
-'''Newton-Rahpson method employed to find the IRR of a given
-   series of cash flows with an tolerance of 1e-7 '''
-def irr(cf_list): 
+'''Discount factors 1/(1+rate)**i for i in [0, n), built by a running product'''
+def discount_factors(rate, n, dtype=np.float64):
+	discounts = np.empty(n, dtype=dtype)
+	discounts[0] = 1.0
+	discounts[1:] = 1.0/(1.0+rate)
+	return np.cumprod(discounts, out=discounts)
+
+'''Computes NPV from precomputed discount factors (see discount_factors)'''
+def npv(cf_list, discounts):
+	return float(np.dot(cf_list, discounts))
+
+#status codes returned by the compiled IRR core
+IRR_FOUND, IRR_OVERFLOW, IRR_NOT_FOUND = 0, 1, 2
+
+#only the fast-math flags that keep overflow detectable with isfinite (the full set lets LLVM fold the check away)
+IRR_FASTMATH = {'contract', 'reassoc'}
+
+'''Compiled Newton-Rahpson core of irr, takes a float64 array of cash flows
+   and returns the rate along with one of the status codes above '''
+@njit(cache=True, fastmath=IRR_FASTMATH, error_model='numpy')
+def _irr_core(cf_arr):
 	#initiate first guess rate x0, hard code maximum iterations and tolerance
-	init_rate = 0 							
-	max_iter = 20							
-	accuracy = 1E-7							
-
-	#initiate next rate x1 to 0 and run iterations, resetting npv and derivative to 0 every iteration 
-	rate = 0						
-	for i in range(0,max_iter):				
-		npv = 0          					
-		derivative = 0
-
-		#compute npv and derivative additively by looping through cash flows                  	
-		for k in range(0, len(cf_list)):
-			try:
-				npv += cf_list[k] / (1+init_rate)**k
-				derivative += -k * cf_list[k] * (1+init_rate)**(-k-1)
-			except (Warning, OverflowError): #error management
-				print("Error: overflow occurred, initial investment possibly not negative or too insignificant in relation to cash flows.")
-				sys.exit()
+	init_rate = 0.0
+	max_iter = 20
+	accuracy = 1E-7
+
+	#initiate next rate x1 to 0 and run iterations, resetting npv and its derivative to 0 every iteration 
+	rate = 0.0
+	for i in range(0,max_iter):
+		npv = 0.0
+		dnpv_dq = 0.0
+
+		#discount factor q = 1/(1+x0), npv is the polynomial sum(cf[k]*q**k)
+		q = 1.0/(1.0+init_rate)
+
+		#evaluate npv and its derivative with respect to q by Horner's method, looping backwards
+		#through cash flows so every step is a multiply-add (contracted into FMAs by fastmath)
+		for k in range(cf_arr.size-1, -1, -1):
+			dnpv_dq = dnpv_dq*q + npv
+			npv = npv*q + cf_arr[k]
+
+		#chain rule, dq/dx0 = -q**2
+		derivative = -q*q*dnpv_dq
 
 		#possible IRR: x1 = x0 - f(x)/f'(x)
 		rate = init_rate - (npv/derivative)
+		if not np.isfinite(rate):
+			return rate, IRR_OVERFLOW
 
 		#test whether difference between x1 and x0 falls within tolerance
 		if np.absolute(rate-init_rate) <= accuracy:
-			return rate
+			return rate, IRR_FOUND
 
 		# x0 = x1 to start new iteration of algorithm
 		init_rate = rate
 
-	print("IRR could not be found!")
-	sys.exit()
+	return rate, IRR_NOT_FOUND
+
+'''Exits the program if any IRR status returned by _irr_core is not IRR_FOUND'''
+def check_irr_status(status):
+	if np.any(status == IRR_OVERFLOW): #error management
+		print("Error: overflow occurred, initial investment possibly not negative or too insignificant in relation to cash flows.")
+		sys.exit()
+	if np.any(status == IRR_NOT_FOUND):
+		print("IRR could not be found!")
+		sys.exit()
 
+'''Newton-Rahpson method employed to find the IRR of a given
+   series of cash flows with an tolerance of 1e-7 '''
+def irr(cf_list):
+	rate, status = _irr_core(np.asarray(cf_list, dtype=np.float64))
+	check_irr_status(status)
+	return rate
+
+'''Compiled NPV of a single row of cash flows given its discount factors'''
+@njit(cache=True, fastmath=IRR_FASTMATH)
+def _npv_core(cf_arr, discounts):
+	npv = 0.0
+	for k in range(0, cf_arr.size):
+		npv += cf_arr[k]*discounts[k]
+	return npv
 
-'''This function uses the normal cumulative distribution to fill an array
-   of random cash flows, and then plots the resulting NPVs and IRRs in histograms '''
+'''Computes the NPV, IRR and IRR status of every row of a (n_sims, N) cash flow
+   matrix, simulations being independent the rows are spread over all cores '''
+@njit(parallel=True, cache=True, fastmath=IRR_FASTMATH, error_model='numpy')
+def compute_all(cf_matrix, discounts):
+	n = cf_matrix.shape[0]
+	npvs = np.empty(n)
+	irrs = np.empty(n)
+	status = np.empty(n, dtype=np.int64)
+	for i in prange(n):
+		npvs[i] = _npv_core(cf_matrix[i], discounts)
+		rate, st = _irr_core(cf_matrix[i])
+		irrs[i] = rate
+		status[i] = st
+	return npvs, irrs, status
+
+
+'''Numeric core of the simulation without any I/O: draws normally distributed random cash flows,
+   and returns the NPV, IRR and IRR status of every simulation along with the average cash flows
+   and their NPV '''
+def _simulate_core(init_invest, rate, life, mean, std_dev, n_sims, rng):
+	#fill array (rows: simulations, columns: cash flows over periods) in one draw
+	#to randomize cash flows based off the given mean and std dev, scaled in place to keep the dtype
+	dtype = np.float32 if n_sims*life >= FLOAT32_MIN_SIZE else np.float64
+	cf_array = rng.standard_normal(size=(n_sims,life), dtype=dtype)
+	with np.errstate(over='ignore'):
+		cf_array *= std_dev
+		cf_array += mean
+	if not (np.isfinite(cf_array.min()) and np.isfinite(cf_array.max())):
+		raise OverflowError("random cash flows overflow their storage, mean or std dev too large.")
+
+	#contiguous matrix of every row with the initial investment prepended
+	full_cf = np.empty((n_sims,life+1), dtype=cf_array.dtype)
+	full_cf[:,0] = init_invest
+	full_cf[:,1:] = cf_array
+
+	#rate is constant so discount factors are computed once, in float64 for the estimates
+	#and cast to the storage dtype for the per-simulation NPVs (a no-op in float64 mode)
+	discounts = discount_factors(rate, life+1)
+
+	#NPV and IRR for every row to plot distributions, rows are solved in parallel
+	npvs, irrs, status = compute_all(full_cf, discounts.astype(dtype, copy=False))
+
+	#compute average cash flows for every period in float64 from the draws, and insert the exact
+	#initial investment at the beginning so that the estimates never depend on the storage dtype,
+	#then their estimated NPV. Overflow in these reductions is fatal (raises FloatingPointError),
+	#the compiled IRR core reports it through its status instead
+	with np.errstate(over='raise', divide='raise', invalid='ignore'):
+		expected_cf = np.empty(life+1)
+		expected_cf[0] = init_invest
+		expected_cf[1:] = cf_array.mean(axis=0, dtype=np.float64)
+		npv_e = npv(expected_cf, discounts)
+
+	return npvs, irrs, status, expected_cf, npv_e
+
+
+'''This function runs the simulation, reports the estimated NPV and IRR
+   and then plots the resulting NPVs and IRRs in histograms '''
 def montecarloSim(invest_params, n_sims, cf_rand_params):
 	print()
 	#initiate investment conditions and elements
 	init_invest, rate, life = invest_params[0], invest_params[1], invest_params[2]
 	mean, std_dev = cf_rand_params[0], cf_rand_params[1]
 
-	#empty array to store random cash flows
-	cf_array = np.ones((n_sims,life))
-
-	#progress bar and time for better user experience
-	pb_mod = round(n_sims/50)
-	pb_pct = 0.0
-	t = time.process_time()
-
-	#loop rows (simulations)
-	for i in range(0,n_sims):
-		#progress bar / status stuff
-		pb = '|'*int((n_sims*pb_pct)/pb_mod)
-		print(f"\rSimulations completed: {i+1}")
-		print(f'> {int(pb_pct*100)}% {pb}', end='\033[1A')
-
-		#loop columns (cash flows over periods) and fill array using normal cumulative distribution 
-		#to randomize cash flows based off the given mean and std dev
-		for j in range(0,life):
-			cf_array[i,j] = norm.ppf(np.random.random(), mean, std_dev)
-
-		#more UI stuff	
-		pb_pct = pb_pct + 0.02 if i%pb_mod == 0 else pb_pct
-		pb_pct = 1.0 if i+2 == n_sims else pb_pct
-
-	print(f"\n\n\nProcess took {time.process_time()-t}s to complete\n")
-
-	#store NPV (with initial investment added) and IRR for every row to plot distributions
-	results = [[npv(row, rate), irr(row)]
-				for row in [np.concatenate((init_invest,cf_array[j,:]),axis=None) for j in range(n_sims)]]
-
-	#compute average cash flows for every period and insert initial investment at the beginning
-	expected_cf = np.mean(cf_array, axis=0)
-	expected_cf = np.concatenate(([init_invest],expected_cf),axis=None)
-
-	#compute estimated NPV and IRR from average cash flows
-	npv_e = np.round(npv(expected_cf, rate),2)
+	#time only the numeric core for better user experience
+	try:
+		t = time.process_time()
+		npvs, irrs, status, expected_cf, npv_e = _simulate_core(init_invest, rate, life, mean, std_dev, n_sims, rng)
+		t = time.process_time()-t
+	except OverflowError as e: #error management
+		print(f"Error: {e}")
+		sys.exit()
+	except FloatingPointError:
+		print("Error: overflow occurred, initial investment possibly not negative or too insignificant in relation to cash flows.")
+		sys.exit()
+	check_irr_status(status)
+
+	#round estimated NPV computed from average cash flows
+	npv_e = np.round(npv_e,2)
+
+	print(f"Simulations completed: {n_sims}")
+	print(f"\nProcess took {t}s to complete\n")
+
+	#compute estimated IRR from average cash flows
 	irr_e = 100*np.round(irr(expected_cf),4)
 
 	print(f"Estimated NPV: {npv_e}")
 	print(f"Estimated IRR: {irr_e}%\n")
 
 	#plot distributions
-	simPlots(results, npv_e, irr_e, n_sims)
+	simPlots(npvs, irrs, npv_e, irr_e, n_sims)
 
 
 '''Plots the distribution of NPVs and IRRs in histograms
    and indicates the estimated NPV and IRR of the model '''
-def simPlots(results, npv_e, irr_e, sims):
-	npv = [item[0] for item in results]
-	irr = [item[1] for item in results]
-
+def simPlots(npvs, irrs, npv_e, irr_e, sims):
 	fig, ax = plt.subplots(1,2,figsize=(12,6))
 
 	print("\nLoading histograms...")
 
-	ax[0].hist(npv, bins=50)
+	ax[0].hist(npvs, bins=50)
 	ax[0].set_title("Distribution of NPVs")
-	ax[1].hist(irr, bins=50)
+	ax[1].hist(irrs, bins=50)
 	ax[1].set_title('Distribution of IRRs')
 	plt.figtext(0.25,0.01,f"Estimated NPV: {npv_e}", ha='center', fontsize=10, color='red')
 	plt.figtext(0.75,0.01,f"Estimated IRR:{irr_e}%", ha='center', fontsize=10, color='red')
 	plt.figtext(0.5,0.95, f"Total simulations ran: {sims}", ha='center', fontsize=10)
 	plt.show()
 
-'''Bad user input management'''
+'''Bad user input management, prompts again until the input is valid'''
 def validate_input(inp, text, conditition):
-	try:
-		inp = float(inp)
-	except ValueError:
-		return validate_input(input(f"Please enter a valid number!\033[K\033[F\033[K{text}"), text, conditition)
-
-	if conditition == '<=0':
-		if not inp <= 0:
-			return validate_input(input(f"Input must be a negative amount!\033[K\033[F\033[K{text}"), text, conditition)
-	if conditition == '>=0':
-		if not inp >= 0:
-			return validate_input(input(f"Input must be a positive amount!\033[K\033[F\033[K{text}"), text, conditition)
-	if conditition == '>0':
-		if not inp > 0 :
-			return validate_input(input(f"Input must be strictly positive amount!\033[K\033[F\033[K{text}"), text, conditition)
-	if conditition == '>99':
-		if not inp > 99:
-			return validate_input(input(f"Simulations must be at least 100!\033[K\033[F\033[K{text}"), text, conditition)
-
-	print("\033[K")
-	return inp
-
-
-'''Main program, I/O stuff'''
-def main():
+	while True:
+		try:
+			inp = float(inp)
+		except ValueError:
+			inp = input(f"Please enter a valid number!\033[K\033[F\033[K{text}")
+			continue
+
+		if conditition == '<=0' and not inp <= 0:
+			inp = input(f"Input must be a negative amount!\033[K\033[F\033[K{text}")
+		elif conditition == '>=0' and not inp >= 0:
+			inp = input(f"Input must be a positive amount!\033[K\033[F\033[K{text}")
+		elif conditition == '>0' and not inp > 0:
+			inp = input(f"Input must be strictly positive amount!\033[K\033[F\033[K{text}")
+		elif conditition == '>99' and not inp > 99:
+			inp = input(f"Simulations must be at least 100!\033[K\033[F\033[K{text}")
+		else:
+			print("\033[K")
+			return inp
+
+
+'''A single simulation run, I/O stuff'''
+def run_once():
 	os.system('CLS')
 	input_requests = [
 						"> Initial investment amount: ",
@@ -168,7 +244,7 @@ def main():
 	print("Welcome to the Monte Carlo simulation of project NPVs and IRRs!")
 	print("Project undertaken by: B. Boustany, H.I. El Husseini, T. Racoillet and C. Smaira")
 	input("\nPress Enter to start the simulation...\n")
-	print(" ! Note: This simulation computes future cash flows using a Normal Cumulative Distribution based on a mean and standard deviation that you must provide")
+	print(" ! Note: This simulation computes future cash flows using a Normal Distribution based on a mean and standard deviation that you must provide")
 	print("\n ! Note: This program's string outputting procedures works best if executed through your computer's command prompt.")
 	print("\nPlease enter the project details\n")
 	project_params = [
@@ -184,10 +260,14 @@ def main():
 
 	montecarloSim(project_params, sims, cf_distribution)
 
-	if input("Would you like to perform another simulation? (Y/n): ").upper() == 'Y':
-		main()
-	else:
-		print("\nEnding program...\n")
+
+'''Main program, runs simulations until the user declines another one'''
+def main():
+	while True:
+		run_once()
+		if input("Would you like to perform another simulation? (Y/n): ").upper() != 'Y':
+			break
+	print("\nEnding program...\n")
 
 
 